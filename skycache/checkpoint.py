@@ -1,10 +1,4 @@
-import hashlib
-import shutil
-import numpy as np
-import pandas as pd
-
 from pathlib import Path
-from io import StringIO
 from typing import Any, Callable, Iterable, List, Optional, Union
 
 from .utils import ignore_path, get_latest_file, hash_md5_recursive, timestamp_from_unique_name
@@ -2,12 +2,47 @@ from __future__ import annotations
 
 import json
 import shutil
+import stat
 
 from io import StringIO
 from pathlib import Path
-from tqdm.auto import tqdm
 
-from typing import List, Iterable, Mapping, Union
+from typing import List, Iterable, Mapping, Optional, Union
+
+try:
+    # インストールされていれば JSON のエンコードに高速な orjson を使用する
+    import orjson
+except ImportError:
+    orjson = None
+
+def _is_orjson_compatible(obj) -> bool:
+    """orjson でエンコードしても json モジュールと同じ表記になる値のみからなるかどうかを判定する。
+    json モジュールは nan や inf を NaN, Infinity と書き出し、絶対値が 1e16 以上か 1e-4 未満の float を
+    1e+16 のような指数表記で書き出すが、orjson はそれぞれ null, 1e16 と書き出す。
+    """
+    if isinstance(obj, float):
+        # nan との比較はすべて False になり、inf は上限で弾かれる
+        return (obj == 0.0) or (1e-4 <= abs(obj) < 1e16)
+    if isinstance(obj, dict):
+        return all(_is_orjson_compatible(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return all(_is_orjson_compatible(v) for v in obj)
+    return True
+
+def _orjson_dumps(obj) -> Optional[bytes]:
+    """obj を orjson でインデント幅 2 の JSON にエンコードする。
+    json.dumps(obj, indent=2) と同じ出力にならない場合は None を返すので、呼び出し側で json モジュールを使用する。
+    """
+    if (orjson is None) or (not _is_orjson_compatible(obj)):
+        return None
+    try:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    except orjson.JSONEncodeError:
+        return None
+    # json モジュールは非 ASCII 文字と DEL を \uXXXX にエスケープするが、orjson はそのまま書き出す
+    if (not data.isascii()) or (b'\x7f' in data):
+        return None
+    return data
 
 from .frozen import FrozenContext
 from .managed import ManagedFile, ManagedDirectory
@@ -86,14 +121,19 @@ class Resource:
             raise KeyError(f"key '{key}' is already exists in table.")
         
         path = Path(path)
-        
-        if (not path.is_file()) and (not path.is_dir()):
-            raise FileNotFoundError(f"path is not file nor directory: '{path}'.")
 
-        if path.is_file():
-            self.table[key] = ManagedFile(path=path, key=key, group=group)
-        elif path.is_dir():
-            self.table[key] = ManagedDirectory(path=path, glob=glob, key=key, group=group, ignore=ignore)
+        # is_file() と is_dir() でそれぞれ stat を呼ばないよう一度だけ取得して使い回す
+        try:
+            st = path.stat()
+        except OSError:
+            st = None
+
+        if (st is not None) and stat.S_ISREG(st.st_mode):
+            self.table[key] = ManagedFile(path=path, key=key, group=group, stat_result=st)
+        elif (st is not None) and stat.S_ISDIR(st.st_mode):
+            self.table[key] = ManagedDirectory(path=path, glob=glob, key=key, group=group, ignore=ignore, stat_result=st)
+        else:
+            raise FileNotFoundError(f"path is not file nor directory: '{path}'.")
 
     def add(self, path: Path, glob: str='**/*', *, key: str=None, group: str=None, ignore: Iterable[str]=None):
         """リソースの追加を行う関数。ファイル、ディレクトリのどちらでも与えることができ、
@@ -137,6 +177,12 @@ class Resource:
 
         # 以下は Iterable, Mapping に対する処理。
 
+        # 最も多い Path のリストの場合は引数の辞書を組み立てずに直接追加する
+        if isinstance(path, list) and all(isinstance(p, (str, Path)) for p in path):
+            for p in path:
+                self._add(key=str(p), path=p, glob=glob, group=group, ignore=ignore)
+            return self
+
         def inherit_args(args, **kwargs):
             ret = { **kwargs }
             if isinstance(args, (str, Path)):
@@ -209,6 +255,12 @@ class Resource:
         str
             JSON 形式の文字列。
         """
+        # orjson が対応しているインデントは 2 のみ
+        if indent == 2:
+            data = _orjson_dumps(self.as_dict())
+            if data is not None:
+                return data.decode('ascii')
+
         with StringIO() as f:
             self.dump(f, indent=indent)
             xs = f.getvalue()
@@ -235,6 +287,11 @@ class Resource:
 
         save_path = dest_dir / f"{self.name}.json"
 
+        data = _orjson_dumps(self.as_dict())
+        if data is not None:
+            save_path.write_bytes(data)
+            return save_path
+
         with open(str(save_path), 'w') as f:
             self.dump(f, indent=2)
         
@@ -292,6 +349,24 @@ class Resource:
         """
         return Snapshot(name=self.name, files=self.files(sort_by_name=True))
 
+    def hash_all(self, workers: int=None) -> Snapshot:
+        """管理対象のファイルのハッシュ値と mtime を並列に計算した Snapshot を返す。
+
+        Parameters
+        ----------
+        workers : int, optional
+            ハッシュ値の計算に使用するスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。
+
+        Returns
+        -------
+        Snapshot
+            ハッシュ値と mtime が計算済みの Snapshot。
+        """
+        snap = self.snapshot()
+        snap.update_table(update_hash=True, update_mtime=True, workers=workers)
+        return snap
+
     def copy(self, dest_dir: Path, verbose=False):
         """管理対象となっているファイルを、ディレクトリ構造を保ったまま別のディレクトリにコピーする。
 
@@ -304,7 +379,7 @@ class Resource:
         """
         return self.snapshot().copy(dest_dir=dest_dir, verbose=verbose)
 
-    def cache_increments(self, db_path: Path, cache_root_dir: Path, verbose=False):
+    def cache_increments(self, db_path: Path, cache_root_dir: Path, verbose=False, force_rehash: bool=False, workers: int=None):
         tag = get_unique_name()
 
         snap = self.snapshot()
@@ -313,17 +388,21 @@ class Resource:
             cache_root_dir=cache_root_dir,
             tag=tag,
             update=True,
+            force_rehash=force_rehash,
+            workers=workers,
             verbose=verbose,
             return_index=True
         )
 
         return df, idx
     
-    def freeze(self, db_path: Path, cache_root_dir: Path, verbose=False):
+    def freeze(self, db_path: Path, cache_root_dir: Path, verbose=False, force_rehash: bool=False, workers: int=None):
         df, idx = self.cache_increments(
             db_path=db_path,
             cache_root_dir=cache_root_dir,
-            verbose=verbose
+            verbose=verbose,
+            force_rehash=force_rehash,
+            workers=workers
         )
 
         return FrozenContext(df, cache_root_dir=cache_root_dir, inc_idx=idx)
\ No newline at end of file
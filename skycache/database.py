@@ -1,65 +1,155 @@
 import sqlite3
+import threading
 import pandas as pd
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 
 from typing import List
 
 from .managed import ManagedFile
 
-def is_table_exists(db_path: Path, table_name: str):
-    try:
-        conn = sqlite3.connect(str(db_path))
-        cur = conn.cursor()
-        
+# 接続ごとに設定する PRAGMA。
+# WAL モードではコミットごとにデータベースファイル全体を同期する必要がなく、読み込みと書き込みが共存できる。
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+]
+
+# search_history で履歴と現在のファイルを照合する条件
+SEARCH_HISTORY_CONDITIONS = {
+    "hash": "H.path = C.path AND H.key = C.key AND H.hash = C.hash",
+    "mtime": "H.path = C.path AND H.key = C.key AND H.mtime = C.mtime",
+    "both": "H.path = C.path AND H.key = C.key AND H.hash = C.hash AND H.mtime = C.mtime",
+}
+
+# search_history の検索クエリの雛形。テーブル名は {table_name} に埋め込む。
+SEARCH_HISTORY_TEMPLATES = {
+    "all": """
+        SELECT H.*
+        FROM (
+            SELECT A.* FROM `{{table_name}}` A INNER JOIN current B ON A.path = B.path AND A.key = B.key
+        ) H JOIN current C ON {cond}
+    """,
+    "recent": """
+        WITH T AS (
+            SELECT H.*,
+                ROW_NUMBER() OVER (PARTITION BY H.path ORDER BY H.time DESC) rn
+            FROM (
+                SELECT A.* FROM `{{table_name}}` A INNER JOIN current B ON A.path = B.path AND A.key = B.key
+            ) H JOIN current C ON {cond}
+        )
+        SELECT `path`, `key`, `tag`, `refer`, `group`, `prefix`, `hash`, `time`, `mtime` FROM T WHERE rn = 1
+    """,
+}
+
+# mode と aware のすべての組み合わせについて予めクエリを組み立てておく
+SEARCH_HISTORY_QUERIES = {
+    (mode, aware): template.format(cond=cond)
+    for mode, template in SEARCH_HISTORY_TEMPLATES.items()
+    for aware, cond in SEARCH_HISTORY_CONDITIONS.items()
+}
+
+@lru_cache(maxsize=256)
+def _search_history_query(table_name: str, mode: str, aware: str) -> str:
+    """search_history のクエリを返す。同じテーブルに対しては同一の文字列が返るので、
+    sqlite3 の文キャッシュによって構文解析が省略される。
+    """
+    if mode not in SEARCH_HISTORY_TEMPLATES:
+        raise ValueError(f"mode must be one of {set(SEARCH_HISTORY_TEMPLATES)}.")
+    if aware not in SEARCH_HISTORY_CONDITIONS:
+        raise ValueError(f"aware must be one of {set(SEARCH_HISTORY_CONDITIONS)}.")
+
+    return SEARCH_HISTORY_QUERIES[(mode, aware)].format(table_name=table_name)
+
+class Database:
+    """SQLite3 のデータベースファイルへの接続を保持し、テーブルに対する操作を提供する。
+    with 文の中で使用すると、ブロック内の操作はすべてひとつの接続を共有し、ブロックを抜けると接続が閉じられる。
+    操作のたびに接続を開き直すコストを避けたい場合に用いる。
+
+    sqlite3 モジュールによる暗黙のトランザクションは使用せず (isolation_level=None)、
+    複数の文をまとめて実行する場合は .transaction() で明示的にトランザクションを開始する。
+
+    ひとつのインスタンスを複数のスレッドで共有してよい。
+    接続を使用する操作はすべてロックによって他のスレッドと排他的に実行されるので、
+    他のスレッドが開始したトランザクションの中で実行されてしまうことはない。
+    """
+    def __init__(self, db_path: Path):
+        self._db_path = Path(db_path)
+        self._conn = sqlite3.connect(str(self._db_path), isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+
+        for pragma in PRAGMAS:
+            self._conn.execute(pragma)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}('{self.db_path}')"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def db_path(self):
+        return self._db_path
+
+    @property
+    def conn(self):
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def transaction(self, mode: str="DEFERRED"):
+        """with 文のブロック内の操作をひとつのトランザクションとして実行する。
+        ブロック内で例外が発生した場合はロールバックする。
+
+        Parameters
+        ----------
+        mode : str, optional
+            トランザクションの種類。"DEFERRED", "IMMEDIATE", "EXCLUSIVE" のいずれか。(by default "DEFERRED")
+        """
+        with self._lock:
+            self.conn.execute(f"BEGIN {mode}")
+            try:
+                yield self
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def is_table_exists(self, table_name: str) -> bool:
         query = f"SELECT COUNT(*) FROM sqlite_master WHERE TYPE='table' AND name='{table_name}'"
-        
-        cur.execute(query)
-    
-        res = cur.fetchone()
+
+        with self._lock:
+            res = self.conn.execute(query).fetchone()
         # 戻り値にはヒットしたテーブルの個数が入っている
-        if res[0] == 0:
-            exists = False
-        else:
-            exists = True
-    finally:
-        conn.close()
-    
-    return exists
+        return res[0] != 0
 
-def drop_table(db_path: Path, table_name: str):
-    try:
-        conn = sqlite3.connect(str(db_path))
-        cur = conn.cursor()
-        
+    def drop_table(self, table_name: str):
         query = f"DROP TABLE IF EXISTS '{table_name}'"
-        
-        cur.execute(query)
-    finally:
-        conn.close()
 
-def get_column_info(db_path: Path, table_name: str):
-    try:
-        conn = sqlite3.connect(str(db_path))
-        cur = conn.cursor()
-        
+        with self._lock:
+            self.conn.execute(query)
+
+    def get_column_info(self, table_name: str):
         query = f"PRAGMA table_info('{table_name}')"
-        res = cur.execute(query)
-        
-        column_info = res.fetchall()
-    finally:
-        conn.close()
-    
-    column_info = [ column for column in column_info ]
-    
-    return column_info
 
-### history
-def create_table(db_path: Path, table_name: str):
-    try:
-        conn = sqlite3.connect(str(db_path))
-        cur = conn.cursor()
-        
+        with self._lock:
+            return self.conn.execute(query).fetchall()
+
+    ### history
+    def create_table(self, table_name: str):
         # group が sqlite3 の予約語なので `` で囲んでエスケープしている。
+        # hash は ManagedFile.hash や JSON への出力と同じ 16 進文字列 (md5 以外はアルゴリズム名付き) のまま保持する。
+        # BLOB にすると既存のテーブルに記録された TEXT のハッシュ値と一致しなくなり、
+        # 読み書きのたびに変換も必要になるため採用しない。
         query = f"""CREATE TABLE IF NOT EXISTS {table_name} (
             `path` TEXT,
             `key` TEXT,
@@ -73,94 +163,125 @@ def create_table(db_path: Path, table_name: str):
             UNIQUE(path, key, tag)
         )
         """
-        
-        cur.execute(query)
-    finally:
-        conn.close()
 
-def insert_or_replace_into_hash_table(db_path: Path, table_name: str, data):
-    try:
-        conn = sqlite3.connect(str(db_path))
-        cur = conn.cursor()
-        
+        # write_hash_table のトランザクション内から呼ばれる場合もあるので再入可能なロックを用いている
+        with self._lock:
+            self.conn.execute(query)
+
+    def insert_or_replace_into_hash_table(self, table_name: str, data):
         query = f"INSERT OR REPLACE INTO `{table_name}` VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        
-        cur.executemany(query, data)
-        conn.commit()
-    finally:
-        conn.close()
 
-def read_table(db_path: Path, table_name: str):
-    try:
-        conn = sqlite3.connect(str(db_path))
-        
+        with self.transaction():
+            self.conn.executemany(query, data)
+
+    def write_hash_table(self, table_name: str, data):
+        """テーブルが存在しなければ作成してから data を挿入する。
+        作成と挿入をひとつのトランザクションで行うので同期は一度で済む。
+        """
+        query = f"INSERT OR REPLACE INTO `{table_name}` VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+        # 読み込みから書き込みへの昇格で競合しないよう最初から書き込みロックを取得する
+        with self.transaction("IMMEDIATE"):
+            self.create_table(table_name)
+            self.conn.executemany(query, data)
+
+    def read_table(self, table_name: str) -> pd.DataFrame:
         query = f"SELECT * FROM `{table_name}`"
-        
-        df = pd.read_sql_query(query, conn)
-    finally:
-        conn.close()
 
-    return df
+        with self._lock:
+            return pd.read_sql_query(query, self.conn)
+
+    def read_table_select(self, table_name: str, managed_files: List[ManagedFile]) -> pd.DataFrame:
+        # 巨大な IN 句を組み立てると呼び出しのたびに SQL の構文解析がやり直しになるので、
+        # 選択対象を一時テーブルに挿入して結合する。
+        # (path, key) での結合には UNIQUE(path, key, tag) のインデックスが使用される。
+        data = [ (str(mf.path), mf.key if mf.key is not None else '') for mf in managed_files ]
+
+        query = f"SELECT A.* FROM `{table_name}` A INNER JOIN selected S ON A.path = S.path AND A.key = S.key"
+
+        # 一時テーブルの中身を読み終えるまで他のスレッドに書き換えられないようにする
+        with self._lock:
+            self.conn.execute("CREATE TEMPORARY TABLE IF NOT EXISTS selected (path TEXT, key TEXT, PRIMARY KEY(path, key))")
+            with self.transaction():
+                self.conn.execute("DELETE FROM selected")
+                self.conn.executemany("INSERT OR IGNORE INTO selected VALUES(?, ?)", data)
+
+            return pd.read_sql_query(query, self.conn)
+
+    def search_history(self, table_name: str, df: pd.DataFrame, mode: str="recent", aware: str="both") -> pd.DataFrame:
+        """
+        data = List[[path, key, hash, mtime]]
+        """
+        data = df[['path', 'key', 'hash', 'mtime']].itertuples(index=False, name=None)
+
+        select_query = _search_history_query(table_name, mode, aware)
+
+        # 一時テーブルの中身を読み終えるまで他のスレッドに書き換えられないようにする
+        with self._lock:
+            # 同じ接続で繰り返し呼ばれた場合は一時テーブルを作り直さずに中身だけ入れ替える
+            query = f"CREATE TEMPORARY TABLE IF NOT EXISTS current (path TEXT, key TEXT, hash TEXT, mtime REAL, UNIQUE(path, key))"
+            self.conn.execute(query)
+
+            query = f"INSERT OR REPLACE INTO current VALUES(?, ?, ?, ?)"
+            with self.transaction():
+                self.conn.execute("DELETE FROM current")
+                self.conn.executemany(query, data)
+
+            return pd.read_sql_query(select_query, self.conn)
+
+@contextmanager
+def open_database(db_path: Path):
+    """db_path に接続した Database を with 文で使用できるようにする。
+    db_path に既に開いている Database が与えられた場合はそれをそのまま使用し、ブロックを抜けても閉じない。
+    一連の操作で同じ接続を使い回したい場合に、パスの代わりに Database を渡せるようにするために用いる。
+
+    Parameters
+    ----------
+    db_path : Path or Database
+        データベースファイルのパス、または開いている Database。
+    """
+    if isinstance(db_path, Database):
+        yield db_path
+        return
+    with Database(db_path) as db:
+        yield db
+
+def is_table_exists(db_path: Path, table_name: str):
+    with open_database(db_path) as db:
+        return db.is_table_exists(table_name)
+
+def drop_table(db_path: Path, table_name: str):
+    with open_database(db_path) as db:
+        db.drop_table(table_name)
+
+def get_column_info(db_path: Path, table_name: str):
+    with open_database(db_path) as db:
+        return db.get_column_info(table_name)
+
+### history
+def create_table(db_path: Path, table_name: str):
+    with open_database(db_path) as db:
+        db.create_table(table_name)
+
+def insert_or_replace_into_hash_table(db_path: Path, table_name: str, data):
+    with open_database(db_path) as db:
+        db.insert_or_replace_into_hash_table(table_name, data)
+
+def write_hash_table(db_path: Path, table_name: str, data):
+    with open_database(db_path) as db:
+        db.write_hash_table(table_name, data)
+
+def read_table(db_path: Path, table_name: str):
+    with open_database(db_path) as db:
+        return db.read_table(table_name)
 
 def read_table_select(db_path: Path, table_name: str, managed_files: List[ManagedFile]):
-    def to_query(managed_files):
-        return ", ".join([f"('{mf.path}', '{mf.key}')" for mf in managed_files ])
-        
-    try:
-        conn = sqlite3.connect(str(db_path))
-        
-        query = f"SELECT * FROM `{table_name}` WHERE (`path`, `key`) IN ({to_query(managed_files)})"
-        
-        df = pd.read_sql_query(query, conn)
-    finally:
-        conn.close()
-
-    return df
+    with open_database(db_path) as db:
+        return db.read_table_select(table_name, managed_files)
 
 def search_history(db_path: Path, table_name: str, df: pd.DataFrame, mode: str="recent", aware: str="both"):
     """
     data = List[[path, key, hash, mtime]]
     """
-    data = [ (row['path'], row['key'], row['hash'], row['mtime']) for _, row in df.iterrows() ]
-
-    if aware == "hash":
-        cond = "H.path = C.path AND H.key = C.key AND H.hash = C.hash"
-    elif aware == "mtime":
-        cond = "H.path = C.path AND H.key = C.key AND H.mtime = C.mtime"
-    elif aware == "both":
-        cond = "H.path = C.path AND H.key = C.key AND H.hash = C.hash AND H.mtime = C.mtime"
-
-    if mode == "all":
-        select_query = f"""
-            SELECT H.*
-            FROM (
-                SELECT A.* FROM `{table_name}` A INNER JOIN current B ON A.path = B.path AND A.key = B.key
-            ) H JOIN current C ON {cond}
-        """
-    elif mode == "recent":
-        select_query = f"""
-            WITH T AS (
-                SELECT H.*,
-                    ROW_NUMBER() OVER (PARTITION BY H.path ORDER BY H.time DESC) rn
-                FROM (
-                    SELECT A.* FROM `{table_name}` A INNER JOIN current B ON A.path = B.path AND A.key = B.key
-                ) H JOIN current C ON {cond}
-            )
-            SELECT `path`, `key`, `tag`, `refer`, `group`, `prefix`, `hash`, `time`, `mtime` FROM T WHERE rn = 1
-        """
-    
-    try:
-        conn = sqlite3.connect(str(db_path))
-        cur = conn.cursor()
-    
-        query = f"CREATE TEMPORARY TABLE current (path TEXT, key TEXT, hash TEXT, mtime REAL, UNIQUE(path, key))"
-        cur.execute(query)
-        
-        query = f"INSERT OR REPLACE INTO current VALUES(?, ?, ?, ?)"
-        cur.executemany(query, data)
-        
-        df = pd.read_sql_query(select_query, conn)
-    finally:
-        conn.close()
-
-    return df
\ No newline at end of file
+    with open_database(db_path) as db:
+        return db.search_history(table_name, df, mode=mode, aware=aware)
@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 
+from collections.abc import Sequence
 from pathlib import Path
 
 class FrozenFile:
@@ -33,6 +35,56 @@ class FrozenFile:
     def path(self):
         return self.cache_root_dir / self.tag / self.origin
 
+class FrozenFileList(Sequence):
+    """FrozenContext から取り出した FrozenFile の列。
+    FrozenFile は要素にアクセスされた時点で生成されるので、列挙されないファイルについてはオブジェクトを作らない。
+
+    以前の FrozenContext.__getitem__ は list を返していたので、比較 (==) と連結 (+) は
+    要素を list にしてから行い、list と同じ結果になるようにしている。
+    ただし list のサブクラスではないので isinstance(x, list) は False になり、要素の代入などの変更もできない。
+    list が必要な場合は list(x) で変換する。
+    """
+    def __init__(self, paths: np.ndarray, refers: np.ndarray, cache_root_dir: Path, positions: np.ndarray=None):
+        self._paths = paths
+        self._refers = refers
+        self._cache_root_dir = cache_root_dir
+        self._positions = positions if positions is not None else np.arange(len(paths))
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenFileList):
+            other = list(other)
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) == other
+
+    # list と同様にハッシュ不可能とする
+    __hash__ = None
+
+    def __add__(self, other):
+        if isinstance(other, FrozenFileList):
+            other = list(other)
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) + other
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return other + list(self)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+
+        pos = self._positions[i]
+        return FrozenFile(path=self._paths[pos], cache_root_dir=self._cache_root_dir, tag=self._refers[pos])
+
 class FrozenContext:
     """
     どのファイルを使用するかまで判明しているコンテキスト。
@@ -41,6 +93,12 @@ class FrozenContext:
         self.df = df
         self.idx = inc_idx
         self.cache_root_dir = Path(cache_root_dir)
+
+        # FrozenFile は取り出されるまで作らず、列ごとの配列として保持する
+        self._paths = df['path'].to_numpy(dtype=object)
+        self._refers = df['refer'].to_numpy(dtype=object)
+        # key から行番号への索引。最初に key で取り出すときに作成する
+        self._key_index = None
     
     def __repr__(self):
         return f"{self.__class__.__name__}()"
@@ -60,29 +118,21 @@ class FrozenContext:
     def is_update_detected(self):
         return len(self.incriments) != 0
 
-    def _as_frozenfile_list(self, df: pd.DataFrame):
-        ret = []
-        for _, row in df.iterrows():
-            ret.append(
-                FrozenFile(
-                    path=row['path'],
-                    cache_root_dir=self.cache_root_dir,
-                    tag=row['refer'],
-                )
-            )
-        
-        return ret
+    def _positions_of(self, key: str) -> np.ndarray:
+        if self._key_index is None:
+            self._key_index = self.df.groupby('key', sort=False).indices
+        return self._key_index.get(key, np.empty(0, dtype=np.intp))
 
     def __getitem__(self, key):
         if isinstance(key, slice):
             if key.start is None and key.stop is None and key.step is None:
-                df = self.df
+                positions = None
             else:
                 raise KeyError(f"specifying start, stop, and step is not allowed.")
         else:
-            df = self.df[self.df['key'] == str(key)]
-        
-        return self._as_frozenfile_list(df)
+            positions = self._positions_of(str(key))
+
+        return FrozenFileList(self._paths, self._refers, self.cache_root_dir, positions)
     
     def group(self, group):
         return ...
\ No newline at end of file
@@ -0,0 +1,158 @@
+import atexit
+import os
+import sqlite3
+import threading
+
+from pathlib import Path
+
+from typing import Optional
+
+from .utils import HASH_ALGORITHM
+
+# ハッシュ値のキャッシュを保存するファイルのパス。
+# 指定しない場合はキャッシュを使用せず、常にファイルを読み込んでハッシュ値を計算する。
+HASH_CACHE_PATH = os.environ.get('SKYCACHE_HASH_CACHE')
+
+# 未書き込みの記録がこの数を超えたらまとめてデータベースに書き込む
+FLUSH_THRESHOLD = 1024
+
+class HashCache:
+    """ファイルのハッシュ値を (path, mtime_ns, size, algorithm) をキーとして保存するキャッシュ。
+    前回の計算から変更されていないファイルはファイルを読み込まずにハッシュ値を得られる。
+    記録はメモリ上に溜めておき、flush を呼び出すか FLUSH_THRESHOLD 件を超えた時点でまとめて書き込む。
+    """
+    def __init__(self, db_path: Path):
+        """sqlite のデータベースファイルを開き、キャッシュのテーブルがなければ作成する。
+
+        Parameters
+        ----------
+        db_path : Path
+            キャッシュを保存するデータベースファイルのパス。
+        """
+        self._db_path = Path(db_path)
+        # ハッシュ値の計算は複数のスレッドから行われるので接続を共有してロックで保護する
+        self._conn = sqlite3.connect(self._db_path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        # (path, algorithm) -> (mtime_ns, size, hash) の未書き込みの記録
+        self._dirty = {}
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS hash_cache (
+                    path TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    hash TEXT NOT NULL,
+                    PRIMARY KEY (path, algorithm)
+                )
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def db_path(self) -> Path:
+        return self._db_path
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._conn.close()
+
+    def flush(self):
+        """未書き込みの記録を一つのトランザクションでまとめてデータベースに書き込む。
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = [ (path, algorithm, *value) for (path, algorithm), value in self._dirty.items() ]
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO hash_cache (path, algorithm, mtime_ns, size, hash) VALUES (?, ?, ?, ?, ?)",
+                    data
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._dirty.clear()
+
+    def get(self, path: Path, stat_result: os.stat_result) -> Optional[str]:
+        """stat が記録時と一致していればキャッシュされたハッシュ値を返す。
+
+        Parameters
+        ----------
+        path : Path
+            ファイルのパス。
+        stat_result : os.stat_result
+            ファイルの現在の stat。
+
+        Returns
+        -------
+        Optional[str]
+            キャッシュされたハッシュ値。キャッシュされていないか、ファイルが変更されている場合は None。
+        """
+        key = (os.path.abspath(path), HASH_ALGORITHM)
+        with self._lock:
+            row = self._dirty.get(key)
+            if row is None:
+                row = self._conn.execute(
+                    "SELECT mtime_ns, size, hash FROM hash_cache WHERE path = ? AND algorithm = ?", key
+                ).fetchone()
+        if row is None:
+            return None
+        mtime_ns, size, hash_ = row
+        if (mtime_ns != stat_result.st_mtime_ns) or (size != stat_result.st_size):
+            return None
+        return hash_
+
+    def put(self, path: Path, stat_result: os.stat_result, hash_: str):
+        """ファイルのハッシュ値を記録する。
+
+        Parameters
+        ----------
+        path : Path
+            ファイルのパス。
+        stat_result : os.stat_result
+            ハッシュ値を計算する直前に取得したファイルの stat。
+        hash_ : str
+            ハッシュ値。
+        """
+        with self._lock:
+            self._dirty[(os.path.abspath(path), HASH_ALGORITHM)] = (stat_result.st_mtime_ns, stat_result.st_size, hash_)
+            if len(self._dirty) >= FLUSH_THRESHOLD:
+                self.flush()
+
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
+
+def get_hash_cache() -> Optional[HashCache]:
+    """HASH_CACHE_PATH に対応する HashCache を返す。
+    初回の呼び出し時に開き、以降は同じインスタンスを使い回す。
+
+    Returns
+    -------
+    Optional[HashCache]
+        HashCache のインスタンス。HASH_CACHE_PATH が指定されていない場合は None。
+    """
+    global _hash_cache
+    if HASH_CACHE_PATH is None:
+        return None
+    with _hash_cache_lock:
+        if _hash_cache is None:
+            _hash_cache = HashCache(HASH_CACHE_PATH)
+            # 終了時に未書き込みの記録が失われないようにする
+            atexit.register(_hash_cache.close)
+    return _hash_cache
+
+def flush_hash_cache():
+    """HASH_CACHE_PATH に対応する HashCache が開かれていれば未書き込みの記録を書き込む。
+    """
+    if _hash_cache is not None:
+        _hash_cache.flush()
@@ -1,13 +1,57 @@
 from __future__ import annotations
 
 import copy
-import filecmp
+import fnmatch
+import os
+import stat
+import sys
 
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path, PurePath
 
-from typing import Callable, Iterable, List
+from typing import Callable, Iterable, List, Optional, Tuple
 
-from .utils import ignore_path, hash_md5
+from .hashcache import flush_hash_cache, get_hash_cache
+from .utils import DEFAULT_WORKERS, compare_files, ignore_path, hash_md5, walk_files
+
+# ManagedDirectory が常に無視するファイル名およびディレクトリ名
+DEFAULT_IGNORE = frozenset({ '__pycache__', '.ipynb_checkpoints' })
+
+# 同じ内容の ignore を ManagedDirectory の間で共有するためのキャッシュ
+_IGNORE_CACHE = { DEFAULT_IGNORE: DEFAULT_IGNORE }
+
+def _normalize_path(path: Path) -> str:
+    """Path と同じ形式に正規化したパスの文字列を返す。
+    Path のインスタンスは生成時に正規化されているので、文字列に戻すだけで再度のパースは行わない。
+    """
+    if isinstance(path, PurePath):
+        return os.fspath(path)
+    return os.fspath(Path(path))
+
+def _stat_signature(st: os.stat_result) -> Tuple[int, int, int, int]:
+    """ファイルの内容が変わっていないことを確認するための stat の要素の組を返す。
+    """
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+@lru_cache(maxsize=1 << 16)
+def _compare_contents(a: Tuple[str, tuple], b: Tuple[str, tuple]) -> bool:
+    """(パス, stat の要素の組) で指定された 2 つのファイルの内容を比較する。
+    stat が変わらない限り同じ組み合わせのファイルを読み直さないよう結果をキャッシュする。
+    """
+    return compare_files(a[0], b[0])
+
+@lru_cache(maxsize=1024)
+def _prefix_with_sep(prefix: str) -> str:
+    """正規化された prefix に前方一致するパスが必ず持つ文字列を返す。
+    """
+    # Path('.').parts は空なので任意のパスに前方一致する
+    if prefix == '.':
+        return ''
+    # ルートディレクトリは既に区切り文字で終わっている
+    if prefix.endswith(os.sep):
+        return prefix
+    return prefix + os.sep
 
 class ManagedFile:
     """管理対象となっているファイルの情報を扱うクラス。
@@ -32,6 +76,10 @@ class ManagedFile:
         取得方法はデフォルトで path.stat().st_mtime である。
         取得には一般にディスクアクセスを伴うため、必要になるまで取得は保留される。
     """
+    # 大量のファイルを管理する場合に備えて __dict__ を持たせず、パスも str で保持してメモリ使用量を抑える
+    # hash_function, mtime_function はほとんどの場合で指定されないので、指定された場合のみ _functions に組で保持する
+    __slots__ = ('_path', '_key', '_prefix', '_group', 'hash', 'mtime', '_functions', '_stat')
+
     def __init__(self, path: Path, *,
                  key: str=None,
                  prefix: Path=None,
@@ -39,7 +87,9 @@ class ManagedFile:
                  hash: str=None,
                  mtime: float=None,
                  hash_function: Callable[[Path], str]=None,
-                 mtime_function: Callable[[Path], float]=None):
+                 mtime_function: Callable[[Path], float]=None,
+                 stat_result: os.stat_result=None,
+                 _normalized: bool=False):
         """
         Parameters
         ----------
@@ -60,6 +110,10 @@ class ManagedFile:
             管理対象となるファイルのハッシュ値の計算する関数。(by default None)
         mtime_function : Callable[[Path], float], optional
             管理対象となるファイルの last modified time を計算する関数。(by default None)
+        stat_result : os.stat_result, optional
+            取得済みの path の stat。(by default None)
+            与えた場合はファイルであることの確認にこれを用い、stat の呼び出しを省略する。
+            与えなかった場合は初期化時に取得する。いずれの場合も保持され、get_mtime で使用される。
 
         Raises
         ------
@@ -73,28 +127,32 @@ class ManagedFile:
         if (group is not None) and (not isinstance(group, str)):
             raise TypeError(f"group must be None or instance of str.")
         
-        self._path = Path(path)
+        # Path と同じ形式に正規化した文字列で保持する
+        # _normalized は内部で既に正規化済みの文字列を渡す場合に再度のパースを省略するために用いる
+        self._path = path if _normalized else _normalize_path(path)
         self._key = key
-        self._prefix = Path(prefix) if prefix is not None else None
+        # 同じ ManagedDirectory から生成されたファイルは prefix の文字列を共有する
+        self._prefix = sys.intern(_normalize_path(prefix)) if prefix is not None else None
         self._group = group
 
         self.hash = hash
         self.mtime = mtime
 
-        self.hash_function = hash_function
-        self.mtime_function = mtime_function
+        self._set_functions(hash_function, mtime_function)
 
-        if not self.path.is_file():
+        # ファイルであることの確認に用いた stat は mtime の取得にも使い回す
+        self._stat = stat_result if stat_result is not None else self._try_stat()
+        if (self._stat is None) or (not stat.S_ISREG(self._stat.st_mode)):
             raise FileNotFoundError(f"No such file: '{self.path}'.")
 
-        if self.prefix is not None:
-            parts = self.prefix.parts
-            if parts != self.path.parts[:len(parts)]:
+        if self._prefix is not None:
+            # 正規化された文字列どうしであれば parts の比較は前方一致の判定に置き換えられる
+            if (self._path != self._prefix) and (not self._path.startswith(_prefix_with_sep(self._prefix))):
                 raise ValueError(f"prefix not match.")
     
     @property
     def path(self):
-        return self._path
+        return Path(self._path)
 
     @property
     def key(self):
@@ -102,18 +160,66 @@ class ManagedFile:
 
     @property
     def prefix(self):
-        return self._prefix
+        return Path(self._prefix) if self._prefix is not None else None
     
     @property
     def group(self):
         return self._group
 
+    @property
+    def hash_function(self):
+        return self._functions[0] if self._functions is not None else None
+
+    @hash_function.setter
+    def hash_function(self, hash_function):
+        self._set_functions(hash_function, self.mtime_function)
+
+    @property
+    def mtime_function(self):
+        return self._functions[1] if self._functions is not None else None
+
+    @mtime_function.setter
+    def mtime_function(self, mtime_function):
+        self._set_functions(self.hash_function, mtime_function)
+
+    def _set_functions(self, hash_function, mtime_function):
+        if (hash_function is None) and (mtime_function is None):
+            self._functions = None
+        else:
+            self._functions = (hash_function, mtime_function)
+
+    def _try_stat(self):
+        try:
+            return os.stat(self._path)
+        except OSError:
+            return None
+
+    def refresh_stat(self) -> ManagedFile:
+        """保持している stat を取得し直す。
+        ファイルが変更された可能性があり、get_mtime で最新の mtime を得たい場合に用いる。
+
+        Returns
+        -------
+        ManagedFile
+            stat が更新されたインスタンス。
+
+        Raises
+        ------
+        FileNotFoundError
+            path で指定されたファイルが存在しなくなった。
+        """
+        st = self._try_stat()
+        if st is None:
+            raise FileNotFoundError(f"No such file: '{self.path}'.")
+        self._stat = st
+        return self
+
     def __repr__(self):
-        params = [f"'{self.path}'"]
+        params = [f"'{self._path}'"]
         if self.key is not None:
             params.append(f"key='{self.key}'")
-        if self.prefix is not None:
-            params.append(f"prefix='{self.prefix}'")
+        if self._prefix is not None:
+            params.append(f"prefix='{self._prefix}'")
         if self.group is not None:
             params.append(f"group='{self.group}'")
         if self.hash is not None:
@@ -131,14 +237,16 @@ class ManagedFile:
             自身のコピー。
         """
         return ManagedFile(
-            path=self.path,
+            path=self._path,
             key=self.key,
-            prefix=self.prefix,
+            prefix=self._prefix,
             group=self.group,
             hash=self.hash,
             mtime=self.mtime,
             hash_function=self.hash_function,
             mtime_function=self.mtime_function,
+            stat_result=self._stat,
+            _normalized=True,
         )
 
     def as_dict(self) -> dict:
@@ -150,11 +258,11 @@ class ManagedFile:
         dict
             ManagedFile の情報を保持する辞書。
         """
-        ret = { 'path': str(self.path) }
+        ret = { 'path': self._path }
         if self.key is not None:
             ret['key'] = self.key
-        if self.prefix is not None:
-            ret['prefix'] = str(self.prefix)
+        if self._prefix is not None:
+            ret['prefix'] = self._prefix
         if self.group is not None:
             ret['group'] = self.group
         if self.hash is not None:
@@ -170,26 +278,44 @@ class ManagedFile:
     def get_hash(self) -> str:
         """管理対象となるファイルのハッシュ値を取得する。
         デフォルトは md5。
+        環境変数 SKYCACHE_HASH_CACHE でキャッシュが指定されている場合、
+        mtime とサイズが前回の計算時から変わっていなければファイルを読み込まずにキャッシュの値を返す。
 
         Returns
         -------
         str
             ハッシュ値。
         """
-        if self.hash_function is not None:
-            return self.hash_function(self.path)
-        return hash_md5(self.path)
+        functions = self._functions
+        if (functions is not None) and (functions[0] is not None):
+            return functions[0](self.path)
+
+        cache = get_hash_cache()
+        if cache is None:
+            return hash_md5(self._path)
+
+        # キャッシュとの照合には最新の stat が必要
+        st = self.refresh_stat()._stat
+        hash_ = cache.get(self._path, st)
+        if hash_ is None:
+            hash_ = hash_md5(self._path)
+            cache.put(self._path, st, hash_)
+        return hash_
 
     def get_mtime(self) -> float:
         """管理対象となるファイルの last modified time を取得する。
-        デフォルトは path.stat().st_mtime。
+        デフォルトは path.stat().st_mtime であり、保持している stat の値を返すのでディスクアクセスは発生しない。
+        最新の値が必要な場合は refresh_stat で stat を取得し直す。
 
         Returns
         -------
         float
             last modified time.
         """
-        return self.path.stat().st_mtime
+        functions = self._functions
+        if (functions is not None) and (functions[1] is not None):
+            return functions[1](self.path)
+        return self._stat.st_mtime
 
     def update_hash(self, copy: bool=False) -> ManagedFile:
         """管理対象となるファイルのハッシュ値を更新したインスタンスを返す。
@@ -224,7 +350,7 @@ class ManagedFile:
             mtime が更新された ManagedFile のインスタンス。
         """
         mf = self if not copy else self.copy()
-        mf.mtime = mf.get_mtime()
+        mf.mtime = mf.refresh_stat().get_mtime()
         return mf
     
     def update(self, copy: bool=False, update_hash: bool=True, update_mtime: bool=True) -> ManagedFile:
@@ -250,7 +376,7 @@ class ManagedFile:
         if update_hash:
             mf.hash = mf.get_hash()
         if update_mtime:
-            mf.mtime = mf.get_mtime()
+            mf.mtime = mf.refresh_stat().get_mtime()
 
         return mf
 
@@ -297,6 +423,24 @@ class ManagedFile:
         """
         return self.defer_hash().defer_mtime()
     
+    def _mtime_ns(self) -> Optional[int]:
+        """mtime が保持している stat から取得されたものであれば、ナノ秒単位の整数の mtime を返す。
+        """
+        if (self.mtime_function is None) and (self.mtime == self._stat.st_mtime):
+            return self._stat.st_mtime_ns
+        return None
+
+    def _is_same_mtime(self, other: ManagedFile) -> bool:
+        """mtime が一致するかどうかを判定する。
+        float の mtime は精度が足りず異なる時刻が一致しうるので、両方ともナノ秒単位の値が得られる場合はそれも比較する。
+        """
+        if self.mtime != other.mtime:
+            return False
+        ns, other_ns = self._mtime_ns(), other._mtime_ns()
+        if (ns is None) or (other_ns is None):
+            return True
+        return ns == other_ns
+
     def is_same_file_with(self, other: ManagedFile, aware: str="mtime_aware") -> bool:
         """ファイルの同一性を比較する。
 
@@ -318,53 +462,143 @@ class ManagedFile:
             * "mtime_only" ... mtime が一致する場合は True。一致しない場合は False。
             * "hash_only" ... hash が一致する場合は True。一致しない場合は False。
             * "both" ... hash と mtime が両方とも一致する場合は True。一致しない場合は False。
-            * "strict" ... filecmp を使用した比較。
+            * "strict" ... ファイルの内容をバイト単位で比較する。
 
         Raises
         ------
         ValueError
             aware に "mtime_only", "hash_only", "mtime_aware", "both", "strict" 以外のモードが指定されている。
         """
-        aware_set = { "mtime_only", "hash_only", "mtime_aware", "both", "strict" }
+        compare = _SAME_FILE_METHODS.get(aware)
+        if compare is None:
+            raise ValueError(f"aware must be one of {set(_AWARE_SET)}.")
+
+        # 同一のインスタンスなら mtime や hash を取得するまでもない。
+        # copy で作られたインスタンスは stat を共有していても hash や mtime が異なりうるので比較を省略しない。
+        if self is other:
+            return True
+
+        return compare(self, other)
+
+    def _is_same_file_mtime_only(self, other: ManagedFile) -> bool:
+        # mtime が未取得なら更新
+        self.defer_mtime()
+        other.defer_mtime()
+        return self._is_same_mtime(other)
+
+    def _is_same_file_hash_only(self, other: ManagedFile) -> bool:
+        # hash が未取得なら更新
+        self.defer_hash()
+        other.defer_hash()
+        return self.hash == other.hash
+
+    def _is_same_file_mtime_aware(self, other: ManagedFile) -> bool:
+        # mtime が未取得なら更新
+        self.defer_mtime()
+        other.defer_mtime()
+        if self._is_same_mtime(other):
+            return True
+        # hash が未取得なら更新
+        self.defer_hash()
+        other.defer_hash()
+        return self.hash == other.hash
+
+    def _is_same_file_both(self, other: ManagedFile) -> bool:
+        # hash, mtime が未取得なら更新
+        self.defer_update()
+        other.defer_update()
+        return self._is_same_mtime(other) and (self.hash == other.hash)
+
+    def _is_same_file_strict(self, other: ManagedFile) -> bool:
+        # 比較結果は stat をキーにキャッシュするので、現在のファイルの状態を反映した stat を取得し直す
+        self.refresh_stat()
+        other.refresh_stat()
+        # 同じ inode を指していれば内容を比較するまでもない
+        if os.path.samestat(self._stat, other._stat):
+            return True
+        a = (self._path, _stat_signature(self._stat))
+        b = (other._path, _stat_signature(other._stat))
+        return _compare_contents(*((a, b) if a <= b else (b, a)))
+
+# is_same_file_with の比較方法と、それぞれの比較を行うメソッドの対応
+_SAME_FILE_METHODS = {
+    "mtime_only": ManagedFile._is_same_file_mtime_only,
+    "hash_only": ManagedFile._is_same_file_hash_only,
+    "mtime_aware": ManagedFile._is_same_file_mtime_aware,
+    "both": ManagedFile._is_same_file_both,
+    "strict": ManagedFile._is_same_file_strict,
+}
+
+# is_same_file_with に指定可能な比較方法
+_AWARE_SET = frozenset(_SAME_FILE_METHODS)
+
+def update_managed_files(files: Iterable[ManagedFile], *,
+                         update_hash: bool=True,
+                         update_mtime: bool=True,
+                         workers: int=None) -> List[ManagedFile]:
+    """複数の ManagedFile の hash, mtime をスレッドプールで並列に更新する。
+    ハッシュ値の計算中は GIL が解放されるため、ファイル数に応じてほぼ線形に高速化される。
+    インスタンスのコピーは行わない。
+
+    Parameters
+    ----------
+    files : Iterable[ManagedFile]
+        更新する ManagedFile。
+    update_hash : bool, optional
+        ハッシュ値を更新するかどうか。(by default True)
+    update_mtime : bool, optional
+        mtime を更新するかどうか。(by default True)
+    workers : int, optional
+        並列に更新を行うスレッド数。(by default None)
+        None の場合は DEFAULT_WORKERS に従う。1 の場合はスレッドを使用せずに逐次更新する。
+
+    Returns
+    -------
+    List[ManagedFile]
+        更新された ManagedFile のリスト。
+    """
+    files = list(files)
+    workers = workers if workers is not None else DEFAULT_WORKERS
 
-        if aware not in aware_set:
-            raise ValueError(f"aware must be one of {aware_set}.")
+    def update(mf):
+        return mf.update(copy=False, update_hash=update_hash, update_mtime=update_mtime)
 
-        if aware == "mtime_only":
-            # mtime が未取得なら更新
-            self.defer_mtime()
-            other.defer_mtime()
-            if self.mtime == other.mtime:
-                return True
-            return False
-        elif aware == "hash_only":
-            # hash が未取得なら更新
-            self.defer_hash()
-            other.defer_hash()
-            if self.hash == other.hash:
-                return True
-            return False
-        elif aware == "mtime_aware":
-            # mtime が未取得なら更新
-            self.defer_mtime()
-            other.defer_mtime()
-            if self.mtime == other.mtime:
-                return True
-            # hash が未取得なら更新
-            self.defer_hash()
-            other.defer_hash()
-            if self.hash == other.hash:
-                return True
-            return False
-        elif aware == "both":
-            # hash, mtime が未取得なら更新
-            self.defer_update()
-            other.defer_update()
-            if (self.mtime == other.mtime) and (self.hash == other.hash):
-                return True
-            return False
-        elif aware == "strict":
-            return filecmp.cmp(str(self.path), str(other.path), shallow=True)
+    if workers <= 1 or len(files) <= 1:
+        ret = [ update(mf) for mf in files ]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            ret = list(executor.map(update, files))
+
+    # 更新の間に溜まったハッシュ値のキャッシュへの記録をまとめて書き込む
+    if update_hash:
+        flush_hash_cache()
+    return ret
+
+def _split_glob(glob: str) -> Optional[Tuple[bool, str]]:
+    """glob のパターンが walk_files による走査で代替できる形式であれば、
+    再帰的に走査するかどうかとファイル名のパターンの組を返す。
+
+    '**/<name>' と '<name>' の形式で、<name> がワイルドカードを含むもののみを対象とし、それ以外は None を返す。
+
+    Parameters
+    ----------
+    glob : str
+        ManagedDirectory に与えられた glob のパターン。
+
+    Returns
+    -------
+    Optional[Tuple[bool, str]]
+        再帰的に走査するかどうかとファイル名のパターンの組。代替できない場合は None。
+    """
+    recursive = glob.startswith('**/')
+    name_pattern = glob[3:] if recursive else glob
+    if (not name_pattern) or ('/' in name_pattern) or ('**' in name_pattern) or (name_pattern in ('.', '..')):
+        return None
+    # ワイルドカードを含まない名前は Path.glob ではファイルシステムへの問い合わせで照合され、
+    # 大文字と小文字を区別しないファイルシステム (macOS の APFS など) では表記の異なる名前にも一致するので代替しない
+    if not any(c in name_pattern for c in '*?['):
+        return None
+    return (recursive, name_pattern)
 
 class ManagedDirectory:
     """管理対象となるファイルをディレクトリ単位で扱うためのクラス。
@@ -380,11 +614,11 @@ class ManagedDirectory:
         path.glob(pattern) に指定する pattern。
     group : str, optional, immutable
         管理グループが存在する場合、そのグループ名。(by default None)
-    ignore : Iterable[str], optional, immutable
-        列挙されたファイルの parts にこの引数の中にある文字列が含まれるとき列挙から除外する。(by default None)
-        None が指定された場合は "__pycache__" と ".ipynb_checkpoints" を無視する。
+    ignore : FrozenSet[str], immutable
+        列挙されたファイルの parts にこの中にある文字列が含まれるとき列挙から除外する。
+        常に "__pycache__" と ".ipynb_checkpoints" を含む。
     """
-    def __init__(self, path: Path, glob: str='**/*', key: str=None, group: str=None, ignore: Iterable[str]=None):
+    def __init__(self, path: Path, glob: str='**/*', key: str=None, group: str=None, ignore: Iterable[str]=None, *, stat_result: os.stat_result=None):
         """_summary_
 
         Parameters
@@ -401,6 +635,9 @@ class ManagedDirectory:
         ignore : Iterable[str], optional
             列挙されたファイルの parts にこの引数の中にある文字列が含まれるとき列挙から除外する。(by default None)
             None が指定された場合は "__pycache__" と ".ipynb_checkpoints" を無視する。
+        stat_result : os.stat_result, optional
+            取得済みの path の stat。(by default None)
+            与えた場合はディレクトリであることの確認にこれを用い、stat の呼び出しを省略する。
 
         Raises
         ------
@@ -422,11 +659,12 @@ class ManagedDirectory:
         self._key = key
         self._group = group
 
-        self._ignore = { '__pycache__', '.ipynb_checkpoints' }
-        if ignore is not None:
-            self._ignore |= set(ignore)
+        # ignore は変更されないので frozenset にして同じ内容のものを使い回す
+        ignore = DEFAULT_IGNORE if ignore is None else DEFAULT_IGNORE.union(ignore)
+        self._ignore = _IGNORE_CACHE.setdefault(ignore, ignore)
 
-        if not self.path.is_dir():
+        is_dir = self.path.is_dir() if stat_result is None else stat.S_ISDIR(stat_result.st_mode)
+        if not is_dir:
             raise FileNotFoundError(f"No such directory: '{self.path}'.")
     
     @property
@@ -451,8 +689,8 @@ class ManagedDirectory:
 
     def __repr__(self):
         if self.group is None:
-            return f"{self.__class__.__name__}('{self.path}', glob='{self.glob}', ignore={self.ignore})"
-        return f"{self.__class__.__name__}('{self.path}', glob='{self.glob}', group='{self.group}', ignore={self.ignore})"
+            return f"{self.__class__.__name__}('{self.path}', glob='{self.glob}', ignore={set(self.ignore)})"
+        return f"{self.__class__.__name__}('{self.path}', glob='{self.glob}', group='{self.group}', ignore={set(self.ignore)})"
 
     def copy(self) -> ManagedDirectory:
         return ManagedDirectory(
@@ -460,7 +698,7 @@ class ManagedDirectory:
             glob=copy.copy(self.glob),
             key=copy.copy(self.key),
             group=copy.copy(self.group),
-            ignore=copy.copy(self.ignore)
+            ignore=self.ignore
         )
 
     def as_dict(self) -> dict:
@@ -482,13 +720,55 @@ class ManagedDirectory:
         ret['ignore'] = list(self.ignore)
         return ret
     
-    def files(self) -> List[ManagedFile]:
+    def files(self, scan_workers: int=None) -> List[ManagedFile]:
         """管理対象となるファイルを列挙する。
 
+        Parameters
+        ----------
+        scan_workers : int, optional
+            サブディレクトリを並列に走査するスレッド数。(by default None)
+            None の場合はスレッドを使用しない。ネットワークファイルシステム上のディレクトリで有効。
+            glob のパターンによっては Path.glob で列挙するため使用されない。
+
         Returns
         -------
         List[ManagedFile]
             管理対象となるファイルのリスト。
         """
-        ps = [ p for p in sorted(self.path.glob(self.glob)) if p.is_file() ]
-        return [ ManagedFile(path=p, key=self.key, prefix=self.path) for p in ignore_path(ps, self.ignore) ]
+        walk = _split_glob(self.glob)
+        if walk is not None:
+            # ファイル名のみを対象とするパターンでは glob を使わずに走査してファイル名を照合する
+            # Path の大小比較と同じ順序になるようにパスの要素ごとに比較する
+            recursive, name_pattern = walk
+            entries = walk_files(self.path, self.ignore, recursive=recursive, workers=scan_workers)
+            if name_pattern != '*':
+                # Path.glob と同様に、Windows では大文字と小文字を区別せずに照合する。
+                # fnmatch.fnmatch は os.path.normcase で正規化してから照合するので、POSIX では fnmatchcase と同じ結果になる。
+                entries = ( (p, st) for p, st in entries if fnmatch.fnmatch(os.path.basename(p), name_pattern) )
+            entries = sorted(entries, key=lambda x: os.path.normcase(x[0]).split(os.sep))
+            # walk_files が返すパスは Path と同じ形式に正規化されている
+            return [ ManagedFile(path=p, key=self.key, prefix=self.path, stat_result=st, _normalized=True) for p, st in entries ]
+
+        # 無視するパスは is_file による stat の前に除外し、残ったものだけを並べ替える
+        ps = ( p for p in ignore_path(self.path.glob(self.glob), self.ignore) if p.is_file() )
+        return [ ManagedFile(path=p, key=self.key, prefix=self.path) for p in sorted(ps) ]
+
+    def update_all(self, update_hash: bool=True, update_mtime: bool=True, workers: int=None) -> List[ManagedFile]:
+        """管理対象となるファイルを列挙し、hash, mtime をスレッドプールで並列に更新する。
+
+        Parameters
+        ----------
+        update_hash : bool, optional
+            ハッシュ値を更新するかどうか。(by default True)
+        update_mtime : bool, optional
+            mtime を更新するかどうか。(by default True)
+        workers : int, optional
+            並列に更新を行うスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。
+
+        Returns
+        -------
+        List[ManagedFile]
+            hash, mtime が更新された管理対象となるファイルのリスト。
+        """
+        return update_managed_files(self.files(), update_hash=update_hash, update_mtime=update_mtime, workers=workers)
@@ -4,35 +4,58 @@ import numpy as np
 import pandas as pd
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from tqdm.auto import tqdm
 
-from typing import Callable, List
+from typing import Callable, Iterable, List
 
-from .managed import ManagedFile
-from .utils import timestamp_from_unique_name
-from .database import \
-    is_table_exists, drop_table, \
-    create_table, read_table, read_table_select, \
-    insert_or_replace_into_hash_table, search_history
+from .managed import ManagedFile, update_managed_files
+from .utils import DEFAULT_WORKERS, HASH_ALGORITHM, copy_and_hash, fast_copy2, hash_algorithm_of, timestamp_from_unique_name
+from .database import open_database, search_history
+
+def _progress(verbose: bool) -> Callable:
+    """進捗表示のためのラッパーを返す。
+    tqdm は読み込み時に IPython の検出などを行い重たいので、実際に表示するときまで import しない。
+    """
+    if not verbose:
+        return lambda x, **kwargs: x
+
+    from tqdm.auto import tqdm
+    return tqdm
+
+def _make_parent_dirs(save_paths: Iterable[Path]):
+    """save_paths の親ディレクトリを作成する。
+    同じディレクトリに多数のファイルを保存する場合でも、ディレクトリごとに一度だけ mkdir を呼び出す。
+    """
+    # 浅い順に作成すれば、深いディレクトリの作成時に親を辿り直す必要がない
+    for parent in sorted({ save_path.parent for save_path in save_paths }, key=lambda d: len(d.parts)):
+        parent.mkdir(parents=True, exist_ok=True)
 
 class SnapshotTableKey:
+    # 辞書のキーとして頻繁に参照されるので、文字列表現とハッシュ値は初期化時に一度だけ計算しておく
+    __slots__ = ('key', 'prefix', 'path', '_s', '_h')
+
     def __init__(self, key=None, prefix=None, path=None):
         self.key = key if key is not None else ''
         self.prefix = prefix if prefix is not None else ''
         self.path = path if path is not None else ''
 
+        self._s = f"{self.key}|{self.prefix}|{self.path}"
+        self._h = hash(self._s)
+
     def __repr__(self):
         return f"{self.__class__.__name__}(key='{self.key}', prefix='{self.prefix}', path='{self.path}')"
 
     def __str__(self):
-        return f"{self.key}|{self.prefix}|{self.path}"
+        return self._s
     
     def __hash__(self):
-        return hash(str(self))
+        return self._h
     
     def __eq__(self, other):
-        return str(self) == str(other)
+        if isinstance(other, SnapshotTableKey):
+            return self._s == other._s
+        return self._s == str(other)
 
 def get_updates(table_cur: dict, table_prev: dict, aware: str="mtime_aware") -> dict:
     """ManagedFile の比較機能を利用して更新の有無を把握する。
@@ -41,7 +64,7 @@ def get_updates(table_cur: dict, table_prev: dict, aware: str="mtime_aware") ->
     * "mtime_only" ... mtime が一致する場合は True。一致しない場合は False。
     * "hash_only" ... hash が一致する場合は True。一致しない場合は False。
     * "both" ... hash と mtime が両方とも一致する場合は True。一致しない場合は False。
-    * "strict" ... filecmp を使用した比較。
+    * "strict" ... ファイルの内容をバイト単位で比較する。
     
     "strict" は実際のファイルを読み取って比較する他、hash, mtime についても ManagedFile に保持されていなければ
     実際のファイルを読み取りに行くことに注意。現在のファイルとキャッシュ先のファイルを比較する場合は、
@@ -84,26 +107,28 @@ def get_updates(table_cur: dict, table_prev: dict, aware: str="mtime_aware") ->
     return updates
 
 def snapshot_table_from_dataframe(df: pd.DataFrame):
-    def null_string_to_None(row, col):
-        return row[col] if row[col] != '' else None
-    
-    def None_to_nan(row, col):
-        return row[col] if row[col] is None else np.nan
+    # 行ごとに Series を生成しないよう、列ごとにまとめて変換してから zip で走査する
+    def null_string_to_None(col):
+        xs = df[col].to_numpy(dtype=object)
+        return np.where(xs == '', None, xs)
+
+    paths = df['path'].to_numpy(dtype=object)
+    keys = null_string_to_None('key')
+    prefixes = null_string_to_None('prefix')
+    groups = null_string_to_None('group')
+    hashes = df['hash'].to_numpy(dtype=object)
+    # None は nan にする
+    mtimes = pd.to_numeric(df['mtime'], errors='coerce').tolist()
 
     ret = {}
-    for _, row in df.iterrows():
-        key = null_string_to_None(row, 'key')
-        prefix = null_string_to_None(row, 'prefix')
-        group = null_string_to_None(row, 'group')
-        mtime = None_to_nan(row, 'mtime')
-
-        k = SnapshotTableKey(key=key, prefix=prefix, path=row['path'])
+    for path, key, prefix, group, hash_, mtime in zip(paths, keys, prefixes, groups, hashes, mtimes):
+        k = SnapshotTableKey(key=key, prefix=prefix, path=path)
         ret[k] = ManagedFile(
-            path=row['path'],
+            path=path,
             key=key,
             prefix=prefix,
             group=group,
-            hash=row['hash'],
+            hash=hash_,
             mtime=mtime,
         )
 
@@ -150,9 +175,9 @@ class Snapshot:
         List[Path]
             管理対象の Path のリスト。
         """
-        return sorted(list(set([ mf.path for mf in self.table.values() ])))
+        return sorted({ mf.path for mf in self.table.values() })
     
-    def update_table(self, update_hash: str=True, update_mtime: str=True):
+    def update_table(self, update_hash: str=True, update_mtime: str=True, workers: int=None):
         """ManagedFile の hash と mtime を更新する。
 
         Parameters
@@ -161,13 +186,71 @@ class Snapshot:
             ハッシュを更新するかどうか。(by default True)
         update_mtime : str, optional
             mtime を更新するかどうか。(by default True)
+        workers : int, optional
+            並列に更新を行うスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。
         """
         if update_hash or update_mtime:
-            for mf in self.table.values():
-                mf.update(copy=False, update_hash=update_hash, update_mtime=update_mtime)
+            update_managed_files(self.table.values(), update_hash=update_hash, update_mtime=update_mtime, workers=workers)
     
-    def _copy(self, dest_dir: Path, path_list: List[Path], verbose: bool=False):
+    def update_table_with_history(self, db_path: Path=None, workers: int=None, *, df_prev: pd.DataFrame=None):
+        """ManagedFile の mtime を更新し、履歴に記録されている mtime と一致するファイルについては
+        履歴のハッシュ値を再利用する。ハッシュ値を計算し直すのは mtime が変化したファイルのみとなるため、
+        変更のないファイルの読み込みを省略できる。
+        独自の hash_function が指定されている ManagedFile は常にハッシュ値を計算し直す。
+        履歴は db_path から読み込むか、.as_hash_table() で取得できるのと同形式のデータフレームを df_prev に直接与える。
+        db_path, df_prev の両方を同時に指定することはできない。
+
+        Parameters
+        ----------
+        db_path : Path or Database, optional
+            履歴の情報が保存されているデータベースファイルのパス。(by default None)
+        workers : int, optional
+            並列にハッシュ値の計算を行うスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。
+        df_prev : pd.DataFrame, optional
+            .as_hash_table() で取得できるのと同形式のデータフレーム。(by default None)
+
+        Raises
+        ------
+        ValueError
+            db_path と df_prev のうちどちらも指定されていないか、両方が指定された。
+        """
+        if (db_path is None) and (df_prev is None):
+            raise ValueError(f"please specify db_path xor df_prev.")
+        if (db_path is not None) and (df_prev is not None):
+            raise ValueError(f"cannot be specified at the same time: db_path and df_prev.")
+
+        # mtime の取得は stat のみで済むので先に行い、ハッシュ値の計算が必要なファイルを絞り込む
+        self.update_table(update_hash=False, update_mtime=True, workers=workers)
+
+        if df_prev is None:
+            df_prev = self.read_hash_table(db_path, select=True)
+
+        cached = {}
+        for path, key, prefix, hash_, mtime in df_prev[['path', 'key', 'prefix', 'hash', 'mtime']].itertuples(index=False, name=None):
+            # 別のアルゴリズムで計算されたハッシュ値は再利用できない
+            if isinstance(hash_, str) and hash_ and hash_algorithm_of(hash_) == HASH_ALGORITHM:
+                cached[(path, key, prefix, mtime)] = hash_
+
+        stale = []
+        for mf in self.table.values():
+            k = (
+                str(mf.path),
+                mf.key if mf.key is not None else '',
+                str(mf.prefix) if mf.prefix is not None else '',
+                mf.mtime,
+            )
+            if (mf.hash_function is None) and (k in cached):
+                mf.hash = cached[k]
+            else:
+                stale.append(mf)
+
+        update_managed_files(stale, update_hash=True, update_mtime=False, workers=workers)
+
+    def _copy(self, dest_dir: Path, path_list: List[Path], verbose: bool=False, workers: int=None):
         """path_list に与えられたファイルのディレクトリ構造を保ったまま dest_dir にコピーする。
+        コピーはスレッドプールで並列に行う。
 
         Parameters
         ----------
@@ -177,6 +260,9 @@ class Snapshot:
             コピーするファイルのパスのリスト。
         verbose : bool, optional
             コピーの進捗状況を表示する。(by default False)
+        workers : int, optional
+            並列にコピーを行うスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。1 の場合はスレッドを使用せずに逐次コピーする。
 
         Raises
         ------
@@ -187,14 +273,27 @@ class Snapshot:
         if len(dest_dir.parts) == 0:
             raise ValueError("current directory is not allowed for destination.")
 
-        wrap = tqdm if verbose else (lambda x: x)
-        
-        for path in wrap(path_list):
-            save_path = dest_dir / path
-            save_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(path, save_path)
+        wrap = _progress(verbose)
+        workers = workers if workers is not None else DEFAULT_WORKERS
+
+        pairs = [ (path, dest_dir / path) for path in path_list ]
+
+        # コピー先のディレクトリは並列にコピーを始める前にまとめて作成しておく
+        _make_parent_dirs(save_path for _, save_path in pairs)
+
+        def copy(pair):
+            fast_copy2(*pair)
+
+        if workers <= 1 or len(pairs) <= 1:
+            for pair in wrap(pairs):
+                copy(pair)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in wrap(executor.map(copy, pairs), total=len(pairs)):
+                pass
     
-    def copy(self, dest_dir: Path, verbose: bool=False):
+    def copy(self, dest_dir: Path, verbose: bool=False, workers: int=None):
         """管理対象のファイルを、ディレクトリ構造を保ったまま dest_fir にコピーする。
 
         Parameters
@@ -203,26 +302,92 @@ class Snapshot:
             コピー先ディレクトリのパス。
         verbose : bool, optional
             コピーの進捗状況を表示する。(by default False)
+        workers : int, optional
+            並列にコピーを行うスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。
         """
-        self._copy(dest_dir=dest_dir, path_list=self.path_list, verbose=verbose)
+        self._copy(dest_dir=dest_dir, path_list=self.path_list, verbose=verbose, workers=workers)
     
+    def copy_and_hash(self, dest_dir: Path, verbose: bool=False, workers: int=None):
+        """管理対象のファイルを、ディレクトリ構造を保ったまま dest_dir にコピーし、
+        コピーのために読み込んだ内容から ManagedFile の hash を更新する。mtime も併せて更新する。
+        copy の後に update_table でハッシュ値を計算する場合と比べて、ファイルの読み込みが一度で済む。
+        独自の hash_function が指定されている ManagedFile は別途ハッシュ値を計算する。
+
+        Parameters
+        ----------
+        dest_dir : Path
+            コピー先ディレクトリのパス。
+        verbose : bool, optional
+            コピーの進捗状況を表示する。(by default False)
+        workers : int, optional
+            並列にコピーを行うスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。1 の場合はスレッドを使用せずに逐次コピーする。
+
+        Raises
+        ------
+        ValueError
+            dest_dir にカレントディレクトリが指定された。
+        shutil.SameFileError
+            コピー先が管理対象のファイル自身になる。絶対パスで管理されているファイルなど。
+        """
+        dest_dir = Path(dest_dir)
+        if len(dest_dir.parts) == 0:
+            raise ValueError("current directory is not allowed for destination.")
+
+        # 同じパスが異なるキーで管理されている場合もコピーは一度だけ行う
+        table = {}
+        for mf in self.table.values():
+            table.setdefault(mf.path, []).append(mf)
+
+        wrap = _progress(verbose)
+        workers = workers if workers is not None else DEFAULT_WORKERS
+
+        paths = sorted(table)
+
+        # 絶対パスで管理されているファイルは dest_dir と結合してもそのままのパスになり、自身に上書きされてしまう。
+        # 一部のファイルだけをコピーした状態で中断しないよう、コピーを始める前に検出する。
+        for path in paths:
+            if dest_dir / path == path:
+                raise shutil.SameFileError(f"'{path}' would be copied onto itself under '{dest_dir}'.")
+
+        _make_parent_dirs(dest_dir / path for path in paths)
+
+        def copy(path):
+            hash_ = copy_and_hash(path, dest_dir / path)
+
+            # 同じパスの ManagedFile は同じタスクでのみ更新されるので、スレッド間で競合しない
+            for mf in table[path]:
+                mf.hash = hash_ if mf.hash_function is None else mf.get_hash()
+                mf.update_mtime()
+
+        if workers <= 1 or len(paths) <= 1:
+            for path in wrap(paths):
+                copy(path)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in wrap(executor.map(copy, paths), total=len(paths)):
+                pass
+
     def drop_hash_table(self, db_path: Path):
         """過去のすべてのキャッシュ情報が記録されたテーブルを削除する。
 
         Parameters
         ----------
-        db_path : Path
+        db_path : Path or Database
             テーブルを保存しているデータベースファイルのパス。
         """
-        if is_table_exists(db_path, self.name):
-            drop_table(db_path, table_name=f"{self.name}")
+        with open_database(db_path) as db:
+            if db.is_table_exists(self.name):
+                db.drop_table(table_name=f"{self.name}")
 
     def read_hash_table(self, db_path: Path, select: bool=True) -> pd.DataFrame:
         """過去のすべてのキャッシュ情報が記録されたテーブルを読み取る。
 
         Parameters
         ----------
-        db_path : Path
+        db_path : Path or Database
             テーブルを保存しているデータベースファイルのパス。
         select : bool, optional
             管理対象のファイルに関連する情報のみを読み取る。(by default True)
@@ -232,12 +397,13 @@ class Snapshot:
         pd.DataFrame
             過去のすべてのキャッシュ情報。
         """
-        if not is_table_exists(db_path, f"{self.name}"):
-            create_table(db_path, self.name)
-        
-        if not select:
-            return read_table(db_path, self.name)
-        return read_table_select(db_path, self.name, self.managed_files)
+        with open_database(db_path) as db:
+            if not db.is_table_exists(f"{self.name}"):
+                db.create_table(self.name)
+
+            if not select:
+                return db.read_table(self.name)
+            return db.read_table_select(self.name, self.managed_files)
     
     @staticmethod
     def _parse_tag_and_timestamp(tag, timestamp):
@@ -270,36 +436,36 @@ class Snapshot:
                       update_hash: bool=False,
                       update_mtime: bool=False) -> pd.DataFrame:
         tag, time = self._parse_tag_and_timestamp(tag, timestamp)
-        
-        table = []
-        for mf in self.table.values():
-            if update_hash or update_mtime:
-                mf.update(update_hash=update_hash, update_mtime=update_mtime)
-
-            path = str(mf.path)
-            key = mf.key if mf.key is not None else ''
-            refer = tag if refer_self else ''
-            hash_ = mf.hash if mf.hash is not None else ''
-            mtime = mf.mtime if mf.mtime is not None else np.nan
-            group = mf.group if mf.group is not None else ''
-            prefix = str(mf.prefix) if mf.prefix is not None else ''
-
-            xs = pd.Series(
-                [path, key, tag, refer, group, prefix, hash_, time, mtime],
-                index=['path', 'key', 'tag', 'refer', 'group', 'prefix', 'hash', 'time', 'mtime']
-            )
-        
-            table.append(xs)
 
-        return pd.DataFrame(table)
+        if update_hash or update_mtime:
+            self.update_table(update_hash=update_hash, update_mtime=update_mtime)
+
+        # 行ごとに Series を作らず、列ごとのリストを一度の走査で作ってからまとめて DataFrame にする
+        mfs = list(self.table.values())
+        n = len(mfs)
+        refer = tag if refer_self else ''
+        cols = {
+            'path': [ str(mf.path) for mf in mfs ],
+            'key': [ mf.key if mf.key is not None else '' for mf in mfs ],
+            'tag': [tag] * n,
+            'refer': [refer] * n,
+            'group': [ mf.group if mf.group is not None else '' for mf in mfs ],
+            'prefix': [ str(mf.prefix) if mf.prefix is not None else '' for mf in mfs ],
+            'hash': [ mf.hash if mf.hash is not None else '' for mf in mfs ],
+            'time': [time] * n,
+            'mtime': [ mf.mtime if mf.mtime is not None else np.nan for mf in mfs ],
+        }
+
+        return pd.DataFrame(cols)
 
     def _insert_or_replace_into_hash_table(self, db_path: Path, df: pd.DataFrame):
-        data = [ row[1:] for row in df.itertuples() ]
+        # 欠損値は NULL として書き込まれるよう None にしておく
+        df = df.astype(object).where(df.notna(), None)
+        # 行はそのまま executemany に渡し、中間のリストを作らずに逐次挿入する
+        data = df.itertuples(index=False, name=None)
         
-        if not is_table_exists(db_path, f"{self.name}"):
-            create_table(db_path, self.name)
-            
-        insert_or_replace_into_hash_table(db_path, self.name, data)
+        with open_database(db_path) as db:
+            db.write_hash_table(self.name, data)
     
     @staticmethod
     def _table_from_dataframe(df: pd.DataFrame):
@@ -354,7 +520,7 @@ class Snapshot:
 
         Parameters
         ----------
-        db_path : Path
+        db_path : Path or Database
             履歴の情報が保存されているデータベースファイルのパス。
         mode : str, optional
             検索モード。"recent", "all" から選ぶ。(by default "recent")
@@ -379,12 +545,17 @@ class Snapshot:
         
         return search_history(db_path, self.name, df, mode=mode, aware=aware)
 
-    def calc_incremental_difference(self, db_path: Path, tag: str, timestamp=None, mode="recent", aware="both", update: bool=False, return_index=False):
-        if update:
-            self.update_table(update_hash=True, update_mtime=True)
+    def calc_incremental_difference(self, db_path: Path, tag: str, timestamp=None, mode="recent", aware="both", update: bool=False, return_index=False, *, force_rehash: bool=False, workers: int=None):
+        # 履歴の読み込みと検索で同じ接続を使い回す
+        with open_database(db_path) as db:
+            if update:
+                if force_rehash:
+                    self.update_table(update_hash=True, update_mtime=True, workers=workers)
+                else:
+                    self.update_table_with_history(db, workers=workers)
 
-        df_current = self.as_hash_table(tag=tag, timestamp=timestamp, refer_self=True, update_hash=False, update_mtime=False)
-        df_history = self.search_history(db_path, mode=mode, aware=aware, update_hash=False, update_mtime=False)
+            df_current = self.as_hash_table(tag=tag, timestamp=timestamp, refer_self=True, update_hash=False, update_mtime=False)
+            df_history = self.search_history(db, mode=mode, aware=aware, update_hash=False, update_mtime=False)
 
         df_refer = df_history[["path", "key", "prefix", "tag", "refer", "group"]]
         df_refer.columns = ["path", "key", "prefix", "tag_history", "refer_history", "group_history"]
@@ -396,25 +567,26 @@ class Snapshot:
         idx = df['refer_history'].isna() | (df['group'] != df['group_history'])
 
         # 変更日時とハッシュが同じファイルが保存されていれば参照先を置き換え
-        df.loc[~idx, 'refer'] = df.loc[~idx, 'refer_history']
+        df['refer'] = np.where(idx, df['refer'], df['refer_history'])
 
         # 増分がないならタグは過去のもので置き換えてよい
         if idx.sum() == 0 and len(df['tag_history'].value_counts()) == 1:
             df['tag'] = df['tag_history']
 
-        df = df[df_current.columns].copy()
+        # 列のリストによる選択は新しい DataFrame を返すので copy は不要
+        df = df[df_current.columns]
 
         if return_index:
             return df, idx
         return df
 
-    def enforce_cache(self, db_path: Path, cache_root_dir: Path, tag: str, timestamp=None):
+    def enforce_cache(self, db_path: Path, cache_root_dir: Path, tag: str, timestamp=None, workers: int=None):
         """現在の管理対象をすべて強制的にキャッシュする。
         定期的にバックアップとして実行しておくとよい。
 
         Parameters
         ----------
-        db_path : Path
+        db_path : Path or Database
             キャッシュ情報を書き込むデータベースファイルのパス。
         cache_root_dir : Path
             キャッシュするファイルを保存しておくディレクトリのパス。
@@ -422,11 +594,15 @@ class Snapshot:
             キャッシュするバージョンにつける名前。
         timestamp : _type_, optional
             付与するタイムスタンプ。(by default None)
+        workers : int, optional
+            並列にコピーを行うスレッド数。(by default None)
+            None の場合は DEFAULT_WORKERS に従う。
         """
         dest_dir = Path(cache_root_dir) / tag
 
-        self.copy(dest_dir=dest_dir)
-        df = self.as_hash_table(tag=tag, refer_self=True, update_hash=True, update_mtime=True)
+        # コピーのために読み込んだ内容からハッシュ値を計算し、同じファイルを二度読み込まないようにする
+        self.copy_and_hash(dest_dir=dest_dir, workers=workers)
+        df = self.as_hash_table(tag=tag, refer_self=True, update_hash=False, update_mtime=False)
         self._insert_or_replace_into_hash_table(db_path, df)
 
     def cache_increments(self,
@@ -438,28 +614,35 @@ class Snapshot:
                          aware="both",
                          update: bool=False,
                          verbose: bool=False,
-                         return_index=False):
+                         return_index=False,
+                         *,
+                         force_rehash: bool=False,
+                         workers: int=None):
         dest_dir = Path(cache_root_dir) / tag
         
-        df_inc, idx = self.calc_incremental_difference(
-            db_path,
-            tag,
-            timestamp=timestamp,
-            mode=mode,
-            aware=aware,
-            update=update,
-            return_index=True
-        )
+        # 増分の計算から書き込みまで同じ接続を使い回す
+        with open_database(db_path) as db:
+            df_inc, idx = self.calc_incremental_difference(
+                db,
+                tag,
+                timestamp=timestamp,
+                mode=mode,
+                aware=aware,
+                update=update,
+                force_rehash=force_rehash,
+                workers=workers,
+                return_index=True
+            )
 
-        df = df_inc[idx]
+            df = df_inc[idx]
 
-        if len(df) == 0:
-            if return_index:
-                return df_inc, idx
-            return df
+            if len(df) == 0:
+                if return_index:
+                    return df_inc, idx
+                return df
 
-        self._copy(dest_dir=dest_dir, path_list=list(map(Path, df['path'])), verbose=verbose)
-        self._insert_or_replace_into_hash_table(db_path=db_path, df=df_inc)
+            self._copy(dest_dir=dest_dir, path_list=list(map(Path, df['path'])), verbose=verbose, workers=workers)
+            self._insert_or_replace_into_hash_table(db_path=db, df=df_inc)
         
         if return_index:
             return df_inc, idx
@@ -1,28 +1,233 @@
+import errno
 import hashlib
+import mmap
+import os
+import stat
+import sys
+import shutil
 import uuid
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from io import StringIO
 
-from typing import Callable, Iterable, List, Optional, Set
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
 
 from .randname import get_random_name
 
-def ignore_path(ps: Iterable[Path], rule: Set[str]) -> List[Path]:
-    return [ p for p in ps if len(rule & set(p.parts)) == 0 ]
+# ファイルのハッシュ値の計算に用いるアルゴリズム。
+# データベースに記録済みのハッシュ値と比較できなくなるので、リポジトリごとに固定して使用する。
+# "md5" と hashlib が対応しているアルゴリズムの他、"xxh3" (xxhash パッケージが必要) と
+# "blake3" (blake3 パッケージが必要) を指定できる。blake3 は SIMD と複数スレッドを用いるので大きなファイルで特に高速。
+# "sha256" は OpenSSL が SHA-NI や ARMv8 の暗号拡張命令を使用できる環境では md5 よりも高速になる。
+HASH_ALGORITHM = os.environ.get('SKYCACHE_HASH', 'md5')
 
-def ignore_python_cache(ps: Iterable[Path]) -> List[Path]:
-    python_cache_set = {'.ipynb_checkpoints', '__pycache__'}
-    
-    return ignore_path(ps, python_cache_set)
+# このサイズを超えるファイルは mmap してからハッシュ値を計算する
+MMAP_THRESHOLD = 1 << 20
+
+# copy_and_hash で一度に読み込むサイズ
+COPY_CHUNK_SIZE = 1 << 20
+
+# Linux で reflink によるコピーを行う ioctl の番号 (linux/fs.h の FICLONE)
+FICLONE = 0x40049409
+
+# ハッシュ値の計算に用いるスレッド数の既定値。
+# 読み込み待ちの間も他のスレッドが計算を進められるよう CPU 数よりも多めに確保する。
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+def _new_hash():
+    """HASH_ALGORITHM に対応するハッシュオブジェクトを生成する。
+    """
+    if HASH_ALGORITHM == 'xxh3':
+        # ハッシュ値の比較にしか用いないので暗号学的な強度は必要ない
+        import xxhash
+        return xxhash.xxh3_128()
+    if HASH_ALGORITHM == 'blake3':
+        # 十分に大きな入力は内部で分割して複数スレッドで計算される
+        import blake3
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.new(HASH_ALGORITHM)
+
+def _tag_hash(hexdigest: str) -> str:
+    """md5 以外のアルゴリズムで計算したハッシュ値には先頭にアルゴリズム名を付与する。
+    アルゴリズムを変更した場合にデータベースに記録済みのハッシュ値と一致しなくなり、
+    変更前のキャッシュが誤って参照されることを防ぐ。
+    """
+    if HASH_ALGORITHM == 'md5':
+        return hexdigest
+    return f"{HASH_ALGORITHM}:{hexdigest}"
+
+def hash_algorithm_of(hash_: str) -> str:
+    """ハッシュ値の計算に用いられたアルゴリズム名を返す。
+    アルゴリズム名が付与されていないハッシュ値は md5 で計算されたものとみなす。
+    """
+    algorithm, sep, _ = hash_.partition(':')
+    return algorithm if sep else 'md5'
+
+def _advise_sequential(fd: int):
+    """先頭から末尾まで順に読み込むことをカーネルに伝え、先読みを積極的に行わせる。
+    対応していないプラットフォームやファイルシステムでは何もしない。
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+
+def _hash_mmap(fd: int) -> str:
+    """ファイルを mmap してハッシュ値を計算する。
+    ユーザ空間のバッファへのコピーが発生しないため、大きなファイルではメモリ帯域を節約できる。
+    """
+    h = _new_hash()
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        for advice in ('MADV_SEQUENTIAL', 'MADV_WILLNEED'):
+            if hasattr(mmap, advice):
+                mm.madvise(getattr(mmap, advice))
+        h.update(mm)
+    return h.hexdigest()
+
+def _open_regular_file(path: Path):
+    """path を読み込み用に開き、開いたファイルと stat の組を返す。
+    通常のファイルであることは開いた後に fstat で確認するので、事前に stat を呼び出す必要がない。
+
+    Raises
+    ------
+    FileNotFoundError
+        指定されたパスにファイルが存在しないか、パスで指定された対象がファイルではない。
+    """
+    # FIFO などを開いたときにブロックしないよう O_NONBLOCK を指定する (通常のファイルの読み込みには影響しない)
+    flags = os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0) | getattr(os, 'O_BINARY', 0)
+    try:
+        fd = os.open(str(path), flags)
+    except (FileNotFoundError, IsADirectoryError):
+        raise FileNotFoundError(f"No such file: '{path}'.") from None
+
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode):
+        os.close(fd)
+        raise FileNotFoundError(f"No such file: '{path}'.")
+
+    # file_digest は自前のバッファに readinto するので Python 側のバッファリングは不要
+    return open(fd, 'rb', buffering=0), st
+
+def _hash_file(path: Path) -> str:
+    """ファイルのハッシュ値を計算する。
+
+    Raises
+    ------
+    FileNotFoundError
+        指定されたパスにファイルが存在しないか、パスで指定された対象がファイルではない。
+    """
+    # file_digest は読み込みとハッシュ計算のループを GIL を解放した状態で実行するので
+    # 複数のスレッドから並列に呼び出すことができる
+    f, st = _open_regular_file(path)
+    with f:
+        if st.st_size > MMAP_THRESHOLD:
+            if HASH_ALGORITHM == 'blake3':
+                # blake3 は自前で mmap し、ファイルを分割して複数スレッドで計算する
+                h = _new_hash()
+                h.update_mmap(str(path))
+                return h.hexdigest()
+            return _hash_mmap(f.fileno())
+        _advise_sequential(f.fileno())
+        return hashlib.file_digest(f, _new_hash).hexdigest()
+
+# ignore_python_cache で除外するディレクトリ名
+PY_CACHE = frozenset({'.ipynb_checkpoints', '__pycache__'})
+
+def ignore_path(ps: Iterable[Path], rule: Set[str]) -> Iterator[Path]:
+    # 呼び出し側で並べ替えたり別のフィルタと組み合わせたりするので、中間のリストを作らずに逐次返す
+    # isdisjoint はパスの要素ごとに集合を作らず、一致する要素が見つかった時点で打ち切る
+    return ( p for p in ps if rule.isdisjoint(p.parts) )
+
+def ignore_python_cache(ps: Iterable[Path]) -> Iterator[Path]:
+    return ignore_path(ps, PY_CACHE)
+
+def _scan_dir(dir_path: str, ignore: Set[str], recursive: bool) -> Tuple[List[str], List[Tuple[str, os.stat_result]]]:
+    """ディレクトリ直下を走査し、降りるべきサブディレクトリとファイルのパスと stat の組を返す。
+    dir_path が空文字列の場合はカレントディレクトリを走査し、パスの先頭に './' を付けない。
+    """
+    dirs, files = [], []
+    try:
+        entries = os.scandir(dir_path or '.')
+    except PermissionError:
+        return dirs, files
+
+    with entries:
+        for entry in entries:
+            if entry.name in ignore:
+                continue
+
+            path = entry.path if dir_path else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    dirs.append(path)
+            elif entry.is_file():
+                files.append((path, entry.stat()))
+    return dirs, files
+
+def walk_files(root: Path, ignore: Set[str], recursive: bool=True, workers: int=None) -> Iterator[Tuple[str, os.stat_result]]:
+    """root 以下のファイルを再帰的に列挙し、パスと stat の組を返す。
+    root.glob('**/*') からファイルのみを選び ignore_path を適用した結果と同じファイルが得られるが、
+    os.scandir を用いるので Path オブジェクトの生成やエントリごとの stat 呼び出しが発生しない。
+    名前が ignore に含まれるディレクトリには降りずに枝刈りする。
+    Path.glob と同様に、シンボリックリンクになっているディレクトリは辿らない。
+    列挙の順序は保証されない。
+
+    Parameters
+    ----------
+    root : Path
+        列挙を開始するディレクトリのパス。
+    ignore : Set[str]
+        列挙から除外するファイル名およびディレクトリ名。
+    recursive : bool, optional
+        サブディレクトリを再帰的に走査するかどうか。(by default True)
+        False の場合は root 直下のファイルのみを列挙する。
+    workers : int, optional
+        サブディレクトリを並列に走査するスレッド数。(by default None)
+        None または 1 以下の場合はスレッドを使用しない。
+        scandir や stat の待ち時間が長いネットワークファイルシステムで有効。
+
+    Returns
+    -------
+    Iterator[Tuple[str, os.stat_result]]
+        ファイルのパスと stat の組。
+    """
+    root = os.fspath(Path(root))
+
+    if not ignore.isdisjoint(Path(root).parts):
+        return
+
+    # カレントディレクトリを走査する場合は Path と同じく先頭に './' を付けない
+    start = '' if root == '.' else root
+
+    if (workers is None) or (workers <= 1):
+        stack = [start]
+        while stack:
+            dirs, files = _scan_dir(stack.pop(), ignore, recursive)
+            stack.extend(dirs)
+            yield from files
+        return
+
+    # 走査が終わったディレクトリから順にサブディレクトリの走査を投入する
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = { executor.submit(_scan_dir, start, ignore, recursive) }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirs, files = future.result()
+                pending.update(executor.submit(_scan_dir, d, ignore, recursive) for d in dirs)
+                yield from files
 
 def get_latest_file(dir_path: Path, glob: str="*", return_None: bool=False) -> Optional[Path]:
     dir_path = Path(dir_path)
     
     paths = sorted(
         ignore_python_cache(dir_path.glob(glob)),
-        key=lambda p: datetime.fromtimestamp(p.stat().st_mtime)
+        # 並べ替えには float の更新時刻をそのまま使い、datetime への変換は行わない
+        key=os.path.getmtime
     )
 
     if len(paths) == 0:
@@ -50,40 +255,207 @@ def hash_md5(path: Path) -> str:
     FileNotFoundError
         指定されたパスにファイルが存在しないか、パスで指定された対象がファイルではない。
     """
-    path = Path(path)
-
-    if not path.is_file():
-        raise FileNotFoundError(f"No such file: '{path}'.")
+    # ファイルであることの確認は開いたファイルに対して行うので、事前の stat は不要
+    return _tag_hash(_hash_file(path))
 
-    with open(str(path), 'rb') as f:
-        data = f.read()
-    return hashlib.md5(data).hexdigest()
-
-def hash_md5_recursive(path: Path, glob: str='**/*') -> str:
+def hash_md5_recursive(path: Path, glob: str='**/*', workers: int=None) -> str:
     path = Path(path)
 
-    if not path.exists():
-        raise FileNotFoundError(f"No such file or directory: '{path}'.")
+    # ファイルかディレクトリかの判定は一度の stat で行う
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        raise FileNotFoundError(f"No such file or directory: '{path}'.") from None
 
-    if (not path.is_file()) and (not path.is_dir()):
-        raise FileNotFoundError(f"path must be a file or a directory: '{path}'.")
+    if stat.S_ISREG(mode):
+        return _tag_hash(_hash_file(path))
 
-    if path.is_file():
-        with open(str(path), 'rb') as f:
-            data = f.read()
-        return hashlib.md5(data).hexdigest()
+    if not stat.S_ISDIR(mode):
+        raise FileNotFoundError(f"path must be a file or a directory: '{path}'.")
 
     if glob is None:
         raise FileNotFoundError(f"path must be a file when glob is None: '{path}'.")
 
-    with StringIO() as buf:
-        for p in sorted([ p for p in ignore_python_cache(path.glob(glob)) if p.is_file() ]):
-            with open(str(p), 'rb') as f:
-                data = f.read()
-            buf.write(hashlib.md5(data).hexdigest())
-        all_hash = buf.getvalue()
+    ps = sorted( p for p in ignore_python_cache(path.glob(glob)) if p.is_file() )
+
+    # 並べ替えた後に投入するので、並列に計算しても結果の順序は変わらない
+    workers = workers if workers is not None else DEFAULT_WORKERS
+    if workers <= 1 or len(ps) <= 1:
+        digests = [ _hash_file(p) for p in ps ]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = list(executor.map(_hash_file, ps))
+
+    # 各ファイルの 16 進表記のハッシュ値を連結したもののハッシュ値と同じになるよう、順に外側のハッシュに与える
+    h = _new_hash()
+    for digest in digests:
+        h.update(digest.encode('ascii'))
+    return _tag_hash(h.hexdigest())
+
+def _raise_if_same_file(src: Path, dst: Path, src_stat: os.stat_result=None):
+    """shutil.copyfile と同様に、src と dst が同じファイルであれば shutil.SameFileError を送出する。
+    dst を切り詰めて開く前に呼び出し、コピー元を空にしてしまわないようにする。
+    """
+    try:
+        if src_stat is None:
+            src_stat = os.stat(str(src))
+        dst_stat = os.stat(str(dst))
+    except OSError:
+        # dst がまだ存在しなければ同じファイルではない
+        return
+    if os.path.samestat(src_stat, dst_stat):
+        raise shutil.SameFileError(f"{str(src)!r} and {str(dst)!r} are the same file")
+
+def copy_and_hash(src: Path, dst: Path) -> str:
+    """src を dst にコピーしながらハッシュ値を計算する。
+    reflink できる場合はデータを複製せずにコピーし、src を読み込んでハッシュ値を計算する。
+    できない場合は読み込んだ内容をそのままハッシュの計算と書き込みに使うので、いずれもファイルの読み込みは一度で済む。
+    shutil.copy2 と同様にメタデータもコピーする。
+
+    Parameters
+    ----------
+    src : Path
+        コピー元のファイルのパス。
+    dst : Path
+        コピー先のファイルのパス。親ディレクトリは存在していなければならない。
+
+    Returns
+    -------
+    str
+        src のハッシュ値。hash_md5(src) と同じ値になる。
+
+    Raises
+    ------
+    shutil.SameFileError
+        src と dst が同じファイルを指している。
+    """
+    # reflink と 'wb' のいずれも dst を切り詰めて開くので、src と同じファイルであれば何もする前に中断する。
+    # 空になったファイルのハッシュ値が返って履歴に記録されることもない。
+    _raise_if_same_file(src, dst)
+
+    if _reflink(src, dst):
+        shutil.copystat(str(src), str(dst))
+        return _tag_hash(_hash_file(src))
+
+    h = _new_hash()
+    buf = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buf)
+
+    with open(str(src), 'rb', buffering=0) as fsrc, open(str(dst), 'wb') as fdst:
+        _advise_sequential(fsrc.fileno())
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            fdst.write(view[:n])
+
+    shutil.copystat(str(src), str(dst))
+
+    return _tag_hash(h.hexdigest())
+
+# reflink が失敗したときに、ファイルシステムが非対応であることを示すエラー番号
+_REFLINK_UNSUPPORTED_ERRNOS = frozenset({ errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY })
+
+# reflink に失敗した (コピー元の st_dev, コピー先の st_dev) の組
+_REFLINK_UNSUPPORTED = set()
+
+def _reflink(src: Path, dst: Path) -> bool:
+    """src の内容を共有する dst を reflink により作成する。
+    Btrfs や XFS など対応しているファイルシステムではファイルサイズに関わらずデータの複製が発生しない。
+
+    Returns
+    -------
+    bool
+        reflink に成功した場合は True。非対応のプラットフォームやファイルシステム、
+        異なるファイルシステム間のコピーの場合は何もせずに False を返す。
+
+    Raises
+    ------
+    shutil.SameFileError
+        src と dst が同じファイルを指している。
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+
+    src_stat = os.stat(str(src))
+    # dst は切り詰めて開くので、src と同じファイルであれば開く前に中断する
+    _raise_if_same_file(src, dst, src_stat)
+
+    # reflink できないことが分かっているデバイスの組み合わせではファイルを開かずに諦める
+    devices = (src_stat.st_dev, os.stat(os.path.dirname(str(dst)) or '.').st_dev)
+    if devices in _REFLINK_UNSUPPORTED:
+        return False
+
+    with open(str(src), 'rb') as fsrc:
+        fd = os.open(str(dst), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+            return True
+        except OSError as e:
+            if e.errno in _REFLINK_UNSUPPORTED_ERRNOS:
+                _REFLINK_UNSUPPORTED.add(devices)
+            return False
+        finally:
+            os.close(fd)
+
+def fast_copy2(src: Path, dst: Path):
+    """shutil.copy2 と同様に src を dst にメタデータも含めてコピーする。
+    可能であれば reflink によりデータを複製せずにコピーし、できなければ shutil.copy2 を使用する。
+    shutil.copy2 は Linux では sendfile、macOS では fcopyfile によりカーネル内でコピーを行う。
+
+    Parameters
+    ----------
+    src : Path
+        コピー元のファイルのパス。
+    dst : Path
+        コピー先のファイルのパス。親ディレクトリは存在していなければならない。
+    """
+    if _reflink(src, dst):
+        shutil.copystat(str(src), str(dst))
+        return
+    shutil.copy2(str(src), str(dst))
+
+def compare_files(path1: Path, path2: Path) -> bool:
+    """2 つのファイルの内容がバイト単位で一致するかどうかを判定する。
+    サイズが異なる場合は内容を読まずに False を返す。
+    読み込み用のバッファを使い回し、チャンクごとの比較は C の memcmp で行われる。
+
+    Parameters
+    ----------
+    path1 : Path
+        比較するファイルのパス。
+    path2 : Path
+        比較するファイルのパス。
+
+    Returns
+    -------
+    bool
+        内容が一致すれば True。
+    """
+    with open(str(path1), 'rb') as f1, open(str(path2), 'rb') as f2:
+        if os.fstat(f1.fileno()).st_size != os.fstat(f2.fileno()).st_size:
+            return False
+
+        _advise_sequential(f1.fileno())
+        _advise_sequential(f2.fileno())
 
-    return hashlib.md5(all_hash.encode('utf-8')).hexdigest()
+        buf1 = bytearray(COPY_CHUNK_SIZE)
+        buf2 = bytearray(COPY_CHUNK_SIZE)
+        while True:
+            n1 = f1.readinto(buf1)
+            n2 = f2.readinto(buf2)
+            if n1 != n2:
+                return False
+            if not n1:
+                return True
+            # memoryview どうしの比較は要素ごとに行われて遅いので bytearray のまま比較する
+            if n1 == COPY_CHUNK_SIZE:
+                if buf1 != buf2:
+                    return False
+            elif buf1[:n1] != buf2[:n2]:
+                return False
 
 def get_unique_name(dateformat=None) -> str:
     now = datetime.now()
@@ -97,7 +469,10 @@ def get_unique_name(dateformat=None) -> str:
     else:
         raise TypeError("dateformat must be instance of str or Callable[[datetime.datetime], str].")
         
-    return '_'.join([ date, get_random_name(0), str(uuid.uuid4()).split('-')[0] ])
+    # uuid4 の文字列表現の先頭 8 文字と同じく、下位 32 ビットを 16 進数 8 桁で表す
+    return '_'.join([ date, get_random_name(0), f"{uuid.uuid4().int & 0xFFFFFFFF:08x}" ])
 
+# タグは変更されないので、同じタグに対する日時の解析結果を使い回す
+@lru_cache(maxsize=4096)
 def timestamp_from_unique_name(tag):
-    return datetime.strptime(tag.split('_')[0], '%Y%m%d-%H%M%S%f').timestamp()
+    return datetime.strptime(tag.partition('_')[0], '%Y%m%d-%H%M%S%f').timestamp()